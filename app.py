@@ -2,12 +2,18 @@ import streamlit as st
 import geopandas as gpd
 import folium
 from streamlit_folium import st_folium
-from sqlalchemy import create_engine, text
-from sqlalchemy.pool import QueuePool
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
 import pandas as pd
 from datetime import datetime
 from urllib.parse import quote_plus
 
+from db_routing import Router, connect_args, pool_capacity
+from export_jobs import ExportManager, EXPORT_FORMATS, GEOMETRY_FORMATS
+from partitions import DIVISIONS, partition_table, leaf_tables, aggregate, aggregate_sql, detect_partitions
+from trends import TREND_METRICS, TREND_DIMENSIONS, TREND_FREQUENCIES, trend
+from layers import CompactLayer, DISTRICT_COLUMNS, ROAD_NETWORK_COLUMNS, memory_report
+
 # Database configuration
 database = {
     'host': "gio-db.cv4gsy2g6s53.ap-south-1.rds.amazonaws.com",
@@ -17,22 +23,47 @@ database = {
     'password': "road_pci",
 }
 
-# SQLAlchemy engine creation with connection pooling
-def get_postgis_engine():
-    url = (
+# Database URL built from the configuration above
+def get_database_url():
+    return (
         f'postgresql+psycopg2://'
         f'{database["user"]}:{quote_plus(database["password"])}'
         f'@{database["host"]}:{database["port"]}'
         f'/{database["db"]}'
     )
-    engine = create_engine(url, poolclass=QueuePool, pool_size=5, max_overflow=10)
-    return engine
 
-# Fetch data from database
+# Routes each workload class (interactive, report, export) to its own connection pool,
+# reading from replicas listed in DATABASE_REPLICA_URLS when they are not lagging
+@st.cache_resource
+def get_router():
+    return Router.from_env(get_database_url())
+
+# Pooled connection for a workload class, failing over to the primary if the chosen replica is down
+def get_connection(workload='interactive', readonly=True):
+    return get_router().connect(workload, readonly)
+
+# Divisions migrated to block partitions, checked once per process; the others are
+# queried through their monolithic table (see partitions.py)
+@st.cache_resource
+def get_partition_layout():
+    with get_connection() as connection:
+        return detect_partitions(connection)
+
+# Aggregate report fanned out over the block partitions of a division
+@st.cache_data(ttl=600)
+def fetch_report_aggregate(division, block, group_by, aggregates, where=None, order_by=None, ascending=False, limit=None):
+    return aggregate(lambda: get_connection('report'), leaf_tables(division, block), group_by, aggregates, where, order_by, ascending, limit)
+
+# Background export jobs, shared by all sessions of this process and sized and timed
+# out like the export workload
+@st.cache_resource
+def get_export_manager():
+    return ExportManager(get_database_url(), max_workers=pool_capacity('export'), connect_args=connect_args('export'))
+
+# Fetch data from database, on the pool of the given workload class
 @st.cache_data(ttl=600)
-def fetch_data(query):
-    engine = get_postgis_engine()
-    with engine.connect() as connection:
+def fetch_data(query, workload='interactive'):
+    with get_connection(workload) as connection:
         gdf = gpd.read_postgis(text(query), con=connection, geom_col='geom')
     
     if gdf.crs is None:
@@ -42,9 +73,8 @@ def fetch_data(query):
 
 # Fetch non-geometry data from database
 @st.cache_data(ttl=600)
-def fetch_non_geom_data(query):
-    engine = get_postgis_engine()
-    with engine.connect() as connection:
+def fetch_non_geom_data(query, workload='interactive'):
+    with get_connection(workload) as connection:
         df = pd.read_sql(query, con=connection)
     return df
 
@@ -59,40 +89,56 @@ road_network_shapefile_path = 'data/RN_DIV'
 
 
 
-# Load district shapefile
+# Load district shapefile, cached as a compact layer along with its memory report
 @st.cache_resource
-def load_district_gdf(path):
+def load_district_layer(path):
     district_gdf = gpd.read_file(path)
     if district_gdf.crs is None:
         district_gdf.set_crs(epsg=4326, inplace=True)
     else:
         district_gdf = district_gdf.to_crs(epsg=4326)
-    return district_gdf
+    district_layer = CompactLayer.from_geodataframe(district_gdf, DISTRICT_COLUMNS)
+    return district_layer, memory_report(district_gdf, district_layer)
 
-district_gdf = load_district_gdf(district_shapefile_path)
+district_layer, district_memory = load_district_layer(district_shapefile_path)
 
 
-# Load road network shapefile
+# Load road network shapefile, cached as a compact layer along with its memory report
 @st.cache_resource
-def load_road_network_gdf(path):
+def load_road_network_layer(path):
     road_network_gdf = gpd.read_file(path)
     if road_network_gdf.crs is None:
         road_network_gdf.set_crs(epsg=4326, inplace=True)
-    return road_network_gdf.to_crs(epsg=4326)
+    road_network_gdf = road_network_gdf.to_crs(epsg=4326)
+    road_network_layer = CompactLayer.from_geodataframe(road_network_gdf, ROAD_NETWORK_COLUMNS)
+    return road_network_layer, memory_report(road_network_gdf, road_network_layer)
 
-road_network_gdf = load_road_network_gdf(road_network_shapefile_path)
+road_network_layer, road_network_memory = load_road_network_layer(road_network_shapefile_path)
 
 # Streamlit app
 st.title("Ratnagiri District Road Network- Query Dasboard and Data Analysis")
 
 # Dropdown for selecting a category
-category = st.selectbox("Select a Category", ["Road Length", "Date", "Road Type", "Scheme Name", "Category of Work", "Contractor Name", "Total Expenditure", "Approved Amount", "Compare Expenditure and Approved Amount", "PCI After Completion of Work", "Current Status","Analysis and Reporting"])
+category = st.selectbox("Select a Category", ["Road Length", "Date", "Road Type", "Scheme Name", "Category of Work", "Contractor Name", "Total Expenditure", "Approved Amount", "Compare Expenditure and Approved Amount", "PCI After Completion of Work", "Current Status", "Trends", "Analysis and Reporting"])
 
 query = ""
+# Pool the query runs on; reports, even ones that only sort rows, use the report pool
+query_workload = "interactive"
+
+# Division to query; each division is stored as its own partition
+selected_division = st.selectbox("Select a Division", list(DIVISIONS))
 
 # Additional filter option for blocks
 st.subheader("Optional: Filter by Block")
-selected_block = st.selectbox("Select a Block (or leave as 'All' to see the entire district)", ["All", "RATNAGIRI", "LANJA", "SANGAMESHWAR", "RAJAPUR"])
+selected_block = st.selectbox("Select a Block (or leave as 'All' to see the entire district)", ["All"] + DIVISIONS[selected_division])
+
+try:
+    get_partition_layout()
+except SQLAlchemyError as e:
+    st.warning(f"Could not check the table layout, reading divisions unpartitioned: {e}")
+
+# Selecting a block narrows queries down to that block's partition
+road_table = partition_table(selected_division, selected_block)
 
 
 # Based on category, show specific options
@@ -101,73 +147,62 @@ if category == "Road Length":
     query_type = st.selectbox("Select Query Type", ["Greater than", "Less than", "Equal to"])
     length_value = st.slider("Select Length (km)", min_value=0.0, max_value=50.0, value=5.0, step=0.1)
 
-    block_filter = f' AND "block_name" = \'{selected_block}\'' if selected_block != "All" else ""
-
     if query_type == "Greater than":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_total_length" > {length_value}{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_total_length" > {length_value}'
     elif query_type == "Less than":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_total_length" < {length_value}{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_total_length" < {length_value}'
     elif query_type == "Equal to":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_total_length" = {length_value}{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_total_length" = {length_value}'
 
 elif category == "Date":
     query_type = st.selectbox("Select Query Type", ["Completed Before", "Completed After", "Approved On", "Approved Before", "Approved After"])
     date_value = st.date_input("Select Date")
     date_str = date_value.strftime('%Y-%m-%d')
 
-    block_filter = f' AND "block_name" = \'{selected_block}\'' if selected_block != "All" else ""
-
     if query_type == "Completed Before":
         query = f'''
-            SELECT * FROM "RN_DIV" 
+            SELECT * FROM {road_table} 
             WHERE 
                 "ratnagiri_final_completion_certificate_date" ~ '^\d{{2}}\.\d{{2}}\.\d{{4}}$'
                 AND TO_DATE("ratnagiri_final_completion_certificate_date", 'DD.MM.YYYY') < '{date_str}'
-                {block_filter}
         '''
     elif query_type == "Completed After":
         query = f'''
-            SELECT * FROM "RN_DIV" 
+            SELECT * FROM {road_table} 
             WHERE 
                 "ratnagiri_final_completion_certificate_date" ~ '^\d{{2}}\.\d{{2}}\.\d{{4}}$'
                 AND TO_DATE("ratnagiri_final_completion_certificate_date", 'DD.MM.YYYY') > '{date_str}'
-                {block_filter}
         '''
     elif query_type == "Approved On":
         query = f'''
-            SELECT * FROM "RN_DIV" 
+            SELECT * FROM {road_table} 
             WHERE 
                 "ratnagiri_final_date_of_approval" ~ '^\d{{2}}\.\d{{2}}\.\d{{4}}$'
                 AND TO_DATE("ratnagiri_final_date_of_approval", 'DD.MM.YYYY') = '{date_str}'
-                {block_filter}
         '''
     elif query_type == "Approved Before":
         query = f'''
-            SELECT * FROM "RN_DIV" 
+            SELECT * FROM {road_table} 
             WHERE 
                 "ratnagiri_final_date_of_approval" ~ '^\d{{2}}\.\d{{2}}\.\d{{4}}$'
                 AND TO_DATE("ratnagiri_final_date_of_approval", 'DD.MM.YYYY') < '{date_str}'
-                {block_filter}
         '''
     elif query_type == "Approved After":
         query = f'''
-            SELECT * FROM "RN_DIV" 
+            SELECT * FROM {road_table} 
             WHERE 
                 "ratnagiri_final_date_of_approval" ~ '^\d{{2}}\.\d{{2}}\.\d{{4}}$'
                 AND TO_DATE("ratnagiri_final_date_of_approval", 'DD.MM.YYYY') > '{date_str}'
-                {block_filter}
         '''
 
 elif category == "Road Type":
     road_types = ["MDR", "NH", "ODR", "RR(ODR)", "RR(VR)", "RR(VR)VR", "SH", "VR"]
     selected_types = st.multiselect("Select Road Types", road_types)
 
-    block_filter = f' AND "block_name" = \'{selected_block}\'' if selected_block != "All" else ""
-
     if selected_types:
         conditions = [f'"drrp_road_" LIKE \'{road_type}%\'' for road_type in selected_types]
         where_clause = " OR ".join(conditions)
-        query = f'SELECT * FROM "RN_DIV" WHERE ({where_clause}){block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE ({where_clause})'
 
 elif category == "Scheme Name":
     scheme_names = [
@@ -180,11 +215,9 @@ elif category == "Scheme Name":
 
     selected_schemes = st.multiselect("Select Scheme Names", scheme_names)
 
-    block_filter = f' AND "block_name" = \'{selected_block}\'' if selected_block != "All" else ""
-
     if selected_schemes:
         scheme_list = "', '".join(selected_schemes)
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_scheme_name" IN (\'{scheme_list}\'){block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_scheme_name" IN (\'{scheme_list}\')'
 
 elif category == "Category of Work":
     category_of_work_groups = {
@@ -215,8 +248,6 @@ elif category == "Category of Work":
 
     selected_categories = st.multiselect("Select Category of Work", list(category_of_work_groups.keys()))
 
-    block_filter = f' AND "block_name" = \'{selected_block}\'' if selected_block != "All" else ""
-
     if selected_categories:
         conditions = []
         for category in selected_categories:
@@ -225,7 +256,7 @@ elif category == "Category of Work":
             conditions.append("(" + " OR ".join(sub_conditions) + ")")
 
         where_clause = " OR ".join(conditions)
-        query = f'SELECT * FROM "RN_DIV" WHERE ({where_clause}){block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE ({where_clause})'
 
 
 
@@ -464,61 +495,51 @@ elif category == "Contractor Name":
 ]        
     selected_contractors = st.multiselect("Select Contractor Names", contractor_names_groups)
 
-    block_filter = f' AND "block_name" = \'{selected_block}\'' if selected_block != "All" else ""
-
     if selected_contractors:
         contractor_list = "', '".join(selected_contractors)
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_contractor_name" IN (\'{contractor_list}\'){block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_contractor_name" IN (\'{contractor_list}\')'
 
 
 elif category == "Total Expenditure":
     query_type = st.selectbox("Select Query Type", ["Greater than", "Less than", "Equal to"])
     expenditure_value = st.slider("Select Expenditure (INR in Lakhs)", min_value=0, max_value=10000, value=1000, step=1)
 
-    block_filter = f' AND "block_name" = \'{selected_block}\'' if selected_block != "All" else ""
-
     if query_type == "Greater than":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_total_expenditure" > {expenditure_value}{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_total_expenditure" > {expenditure_value}'
     elif query_type == "Less than":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_total_expenditure" < {expenditure_value}{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_total_expenditure" < {expenditure_value}'
     elif query_type == "Equal to":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_total_expenditure" = {expenditure_value}{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_total_expenditure" = {expenditure_value}'
 
 elif category == "Approved Amount":
     query_type = st.selectbox("Select Query Type", ["Greater than", "Less than", "Equal to"])
     approved_amount_value = st.slider("Select Approved Amount (INR in Lakhs)", min_value=0, max_value=10000, value=1000, step=1)
 
-    block_filter = f' AND "block_name" = \'{selected_block}\'' if selected_block != "All" else ""
-
     if query_type == "Greater than":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_approved_amount" > {approved_amount_value}{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_approved_amount" > {approved_amount_value}'
     elif query_type == "Less than":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_approved_amount" < {approved_amount_value}{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_approved_amount" < {approved_amount_value}'
     elif query_type == "Equal to":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_approved_amount" = {approved_amount_value}{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_approved_amount" = {approved_amount_value}'
 
 elif category == "Compare Expenditure and Approved Amount":
     query_type = st.selectbox("Select Query Type", ["Expenditure exceeds Approved Amount", "Approved Amount exceeds Expenditure"])
 
-    block_filter = f' AND "block_name" = \'{selected_block}\'' if selected_block != "All" else ""
-
     if query_type == "Expenditure exceeds Approved Amount":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_total_expenditure" > "ratnagiri_final_approved_amount"{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_total_expenditure" > "ratnagiri_final_approved_amount"'
     elif query_type == "Approved Amount exceeds Expenditure":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_approved_amount" > "ratnagiri_final_total_expenditure"{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_approved_amount" > "ratnagiri_final_total_expenditure"'
 
 elif category == "PCI After Completion of Work":
     query_type = st.selectbox("Select Query Type", ["Greater than", "Less than", "Equal to"])
     pci_value = st.slider("Select PCI Value", min_value=0, max_value=100, value=50)
 
-    block_filter = f' AND "block_name" = \'{selected_block}\'' if selected_block != "All" else ""
-
     if query_type == "Greater than":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_pci_after_completion_of_work" > {pci_value}{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_pci_after_completion_of_work" > {pci_value}'
     elif query_type == "Less than":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_pci_after_completion_of_work" < {pci_value}{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_pci_after_completion_of_work" < {pci_value}'
     elif query_type == "Equal to":
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_pci_after_completion_of_work" = {pci_value}{block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_pci_after_completion_of_work" = {pci_value}'
 
 elif category == "Current Status":
     current_status_groups = {
@@ -532,27 +553,23 @@ elif category == "Current Status":
         'Others': []  
     }
 
-    engine = get_postgis_engine()
-    with engine.connect() as connection:
-        result = connection.execute(text('SELECT DISTINCT "ratnagiri_final_current_status" FROM "RN_DIV"'))
+    with get_connection() as connection:
+        result = connection.execute(text(f'SELECT DISTINCT "ratnagiri_final_current_status" FROM {road_table}'))
         all_statuses = [row[0] for row in result if row[0] not in sum(current_status_groups.values(), [])]
 
     current_status_groups['Others'] = all_statuses
     all_current_statuses = sum(current_status_groups.values(), [])
     selected_current_statuses = st.multiselect("Select Current Status", all_current_statuses)
 
-    block_filter = f' AND "block_name" = \'{selected_block}\'' if selected_block != "All" else ""
-
     if selected_current_statuses:
         filtered_statuses = filter(None, selected_current_statuses)
         values_list = "', '".join(filtered_statuses)
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_current_status" IN (\'{values_list}\'){block_filter}'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_current_status" IN (\'{values_list}\')'
 
     
     # Fetch all unique status values from the database
-    engine = get_postgis_engine()
-    with engine.connect() as connection:
-        result = connection.execute(text('SELECT DISTINCT "ratnagiri_final_current_status" FROM "RN_DIV"'))
+    with get_connection() as connection:
+        result = connection.execute(text(f'SELECT DISTINCT "ratnagiri_final_current_status" FROM {road_table}'))
         all_statuses = [row[0] for row in result if row[0] not in sum(current_status_groups.values(), [])]
     
     current_status_groups['Others'] = all_statuses
@@ -568,7 +585,28 @@ elif category == "Current Status":
         filtered_statuses = filter(None, selected_current_statuses)
         # Convert the selected values to a string for SQL IN clause
         values_list = "', '".join(filtered_statuses)
-        query = f'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_current_status" IN (\'{values_list}\')'
+        query = f'SELECT * FROM {road_table} WHERE "ratnagiri_final_current_status" IN (\'{values_list}\')'
+
+elif category == "Trends":
+    trend_metric = st.selectbox("Select Metric", list(TREND_METRICS), format_func=lambda m: {"pci": "PCI After Completion of Work", "expenditure": "Total Expenditure"}[m])
+    trend_by = st.selectbox("Group By", list(TREND_DIMENSIONS), format_func=str.title)
+    trend_freq = st.selectbox("Bucket Size", list(TREND_FREQUENCIES), format_func=str.title)
+    trend_window = st.slider("Rolling Window (buckets)", min_value=1, max_value=12, value=4)
+    trend_value = st.selectbox("Plot", ["rolling_mean", "mean", "sum", "count", "p50", "p90"])
+
+    # Computed in memory from one query per data version, see trends.py
+    try:
+        with get_router().connect('report') as connection:
+            trend_df = trend(connection, selected_division, trend_metric, by=trend_by, freq=trend_freq, window=trend_window, block=selected_block, primary=lambda: get_connection(readonly=False))
+        series = trend_df.pivot(index="period", columns=trend_by, values=trend_value)
+        if trend_by != "division":
+            # Keep the chart readable by plotting the series with the most data
+            top = trend_df.groupby(trend_by)["count"].sum().nlargest(10).index
+            series = series[top]
+        st.line_chart(series)
+        st.write(trend_df)
+    except Exception as e:
+        st.error(f"An error occurred while computing the trend: {e}")
 
 if category == "Analysis and Reporting":
     report_query = st.selectbox("Select Report Query", [
@@ -644,51 +682,64 @@ if category == "Analysis and Reporting":
         "Total Expenditure by Road Owner"
     ]
 
-    # Define the queries
-    queries = {
-        "Total Length of Roads by Taluka": 'SELECT "ratnagiri_final_taluka" AS Taluka, SUM("ratnagiri_final_total_length") AS TotalLength FROM "RN_DIV" GROUP BY "ratnagiri_final_taluka"',
-        "Total Expenditure on Roads by Contractor": 'SELECT "ratnagiri_final_contractor_name", SUM("ratnagiri_final_total_expenditure") AS TotalExpenditure FROM "RN_DIV" GROUP BY "ratnagiri_final_contractor_name"',
-        "Total Expenditure by Road Category": 'SELECT "roadcatego", SUM("ratnagiri_final_total_expenditure") AS TotalExpenditure FROM "RN_DIV" GROUP BY "roadcatego"',
-        "Roads with Highest Approved Amount (Top 10)": 'SELECT * FROM "RN_DIV" ORDER BY "ratnagiri_final_approved_amount" DESC LIMIT 10',
-        "Roads with Lowest Approved Amount (Bottom 10)": 'SELECT * FROM "RN_DIV" ORDER BY "ratnagiri_final_approved_amount" ASC LIMIT 10',
-        "Roads with Delayed Completion": 'SELECT * FROM "RN_DIV" WHERE "ratnagiri_final_current_status" = \'Delayed\'',
-        "Roads by Contractor and Current Status": 'SELECT "ratnagiri_final_contractor_name", "ratnagiri_final_current_status", COUNT(*) AS RoadCount FROM "RN_DIV" GROUP BY "ratnagiri_final_contractor_name", "ratnagiri_final_current_status"',
-        "Count of Roads by Description of Work": 'SELECT "ratnagiri_final_description_of_work", COUNT(*) AS RoadCount FROM "RN_DIV" GROUP BY "ratnagiri_final_description_of_work"',
-        "Total Length of Roads by Scheme Name": 'SELECT "ratnagiri_final_scheme_name", SUM("ratnagiri_final_total_length") AS TotalLength FROM "RN_DIV" GROUP BY "ratnagiri_final_scheme_name"',
-        "Total Approved Amount by Contractor": 'SELECT "ratnagiri_final_contractor_name", SUM("ratnagiri_final_approved_amount") AS TotalApprovedAmount FROM "RN_DIV" GROUP BY "ratnagiri_final_contractor_name"',
-        "Average Expenditure per Road by Contractor": 'SELECT "ratnagiri_final_contractor_name", AVG("ratnagiri_final_total_expenditure") AS AverageExpenditure FROM "RN_DIV" GROUP BY "ratnagiri_final_contractor_name"',
-        "Top 5 Contractors by Average PCI After Completion": 'SELECT "ratnagiri_final_contractor_name", AVG("ratnagiri_final_pci_after_completion_of_work") AS AveragePCI FROM "RN_DIV" GROUP BY "ratnagiri_final_contractor_name" ORDER BY AveragePCI DESC LIMIT 5',
-        "Roads with High Expenditure to Length Ratio (Top 10)": 'SELECT *, ("ratnagiri_final_total_expenditure" / "ratnagiri_final_total_length") AS ExpenditureToLengthRatio FROM "RN_DIV" ORDER BY ExpenditureToLengthRatio DESC LIMIT 10',
-        "Top 5 Schemes by Average Length of Roads": 'SELECT "ratnagiri_final_scheme_name", AVG("ratnagiri_final_total_length") AS AverageLength FROM "RN_DIV" GROUP BY "ratnagiri_final_scheme_name" ORDER BY AverageLength DESC LIMIT 5',
-        "Contractor Workload: Number of Projects and Total Length": 'SELECT "ratnagiri_final_contractor_name", COUNT(*) AS NumberOfProjects, SUM("ratnagiri_final_total_length") AS TotalLength FROM "RN_DIV" GROUP BY "ratnagiri_final_contractor_name"',
-        "Top 10 Contractors with Most Roads Completed": 'SELECT "ratnagiri_final_contractor_name", COUNT(*) AS CompletedRoads FROM "RN_DIV" WHERE "ratnagiri_final_current_status" = \'Completed\' GROUP BY "ratnagiri_final_contractor_name" ORDER BY CompletedRoads DESC LIMIT 10',
-        "Bottom 10 Contractors with Fewest Roads Completed": 'SELECT "ratnagiri_final_contractor_name", COUNT(*) AS CompletedRoads FROM "RN_DIV" WHERE "ratnagiri_final_current_status" = \'Completed\' GROUP BY "ratnagiri_final_contractor_name" ORDER BY CompletedRoads ASC LIMIT 10',
-        "Count of Roads by Scheme Name": 'SELECT "ratnagiri_final_scheme_name", COUNT(*) AS RoadCount FROM "RN_DIV" GROUP BY "ratnagiri_final_scheme_name"',
-        "Average Expenditure by Road Category": 'SELECT "roadcatego", AVG("ratnagiri_final_total_expenditure") AS AverageExpenditure FROM "RN_DIV" GROUP BY "roadcatego"',
-        "Median Approved Amount by Contractor": 'SELECT "ratnagiri_final_contractor_name", PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY "ratnagiri_final_approved_amount") AS MedianApprovedAmount FROM "RN_DIV" GROUP BY "ratnagiri_final_contractor_name"',
-        "Total Length of Roads by Contractor": 'SELECT "ratnagiri_final_contractor_name", SUM("ratnagiri_final_total_length") AS TotalLength FROM "RN_DIV" GROUP BY "ratnagiri_final_contractor_name"',
-        "Count of Roads by Status": 'SELECT "ratnagiri_final_current_status", COUNT(*) AS RoadCount FROM "RN_DIV" GROUP BY "ratnagiri_final_current_status"',
-        "Average Length of Roads by Taluka": 'SELECT "ratnagiri_final_taluka", AVG("ratnagiri_final_total_length") AS AverageLength FROM "RN_DIV" GROUP BY "ratnagiri_final_taluka"',
-        "Top 10 Roads by Expenditure per Kilometer": 'SELECT *, ("ratnagiri_final_total_expenditure" / "ratnagiri_final_total_length") AS ExpenditurePerKm FROM "RN_DIV" ORDER BY ExpenditurePerKm DESC LIMIT 10',
-        "Count of Roads by Department": 'SELECT "ratnagiri_final_department", COUNT(*) AS RoadCount FROM "RN_DIV" GROUP BY "ratnagiri_final_department"',
-        "Average PCI After Completion by Taluka": 'SELECT "ratnagiri_final_taluka", AVG("ratnagiri_final_pci_after_completion_of_work") AS AveragePCI FROM "RN_DIV" GROUP BY "ratnagiri_final_taluka"',
-        "Total Expenditure by Block": 'SELECT "block_name", SUM("ratnagiri_final_total_expenditure") AS TotalExpenditure FROM "RN_DIV" GROUP BY "block_name"',
-        "Contractor with Maximum Number of Roads": 'SELECT "ratnagiri_final_contractor_name", COUNT(*) AS NumberOfRoads FROM "RN_DIV" GROUP BY "ratnagiri_final_contractor_name" ORDER BY NumberOfRoads DESC LIMIT 1',
-        "Top 10 Roads by Total Expenditure": 'SELECT * FROM "RN_DIV" ORDER BY "ratnagiri_final_total_expenditure" DESC LIMIT 10',
-        "Bottom 10 Roads by Total Expenditure": 'SELECT * FROM "RN_DIV" ORDER BY "ratnagiri_final_total_expenditure" ASC LIMIT 10',
-        "Count of Roads by Category of Work": 'SELECT "ratnagiri_final_category_of_work", COUNT(*) AS RoadCount FROM "RN_DIV" GROUP BY "ratnagiri_final_category_of_work"',
-        "Average Approved Amount by Scheme Name": 'SELECT "ratnagiri_final_scheme_name", AVG("ratnagiri_final_approved_amount") AS AverageApprovedAmount FROM "RN_DIV" GROUP BY "ratnagiri_final_scheme_name"',
-        "Total Expenditure by Road Owner": 'SELECT "roadowner", SUM("ratnagiri_final_total_expenditure") AS TotalExpenditure FROM "RN_DIV" GROUP BY "roadowner"'
+    # Reports built from SUM/COUNT/AVG aggregates run on each block partition in
+    # parallel and the partial results are merged: (group by, aggregates, where, order by, ascending, limit)
+    completed_filter = '"ratnagiri_final_current_status" = \'Completed\''
+    report_aggregates = {
+        "Total Length of Roads by Taluka": (["ratnagiri_final_taluka"], {"totallength": ("sum", "ratnagiri_final_total_length")}, None, None, False, None),
+        "Total Expenditure on Roads by Contractor": (["ratnagiri_final_contractor_name"], {"totalexpenditure": ("sum", "ratnagiri_final_total_expenditure")}, None, None, False, None),
+        "Total Expenditure by Road Category": (["roadcatego"], {"totalexpenditure": ("sum", "ratnagiri_final_total_expenditure")}, None, None, False, None),
+        "Roads by Contractor and Current Status": (["ratnagiri_final_contractor_name", "ratnagiri_final_current_status"], {"roadcount": ("count", None)}, None, None, False, None),
+        "Count of Roads by Description of Work": (["ratnagiri_final_description_of_work"], {"roadcount": ("count", None)}, None, None, False, None),
+        "Total Length of Roads by Scheme Name": (["ratnagiri_final_scheme_name"], {"totallength": ("sum", "ratnagiri_final_total_length")}, None, None, False, None),
+        "Total Approved Amount by Contractor": (["ratnagiri_final_contractor_name"], {"totalapprovedamount": ("sum", "ratnagiri_final_approved_amount")}, None, None, False, None),
+        "Average Expenditure per Road by Contractor": (["ratnagiri_final_contractor_name"], {"averageexpenditure": ("avg", "ratnagiri_final_total_expenditure")}, None, None, False, None),
+        "Top 5 Contractors by Average PCI After Completion": (["ratnagiri_final_contractor_name"], {"averagepci": ("avg", "ratnagiri_final_pci_after_completion_of_work")}, None, "averagepci", False, 5),
+        "Top 5 Schemes by Average Length of Roads": (["ratnagiri_final_scheme_name"], {"averagelength": ("avg", "ratnagiri_final_total_length")}, None, "averagelength", False, 5),
+        "Contractor Workload: Number of Projects and Total Length": (["ratnagiri_final_contractor_name"], {"numberofprojects": ("count", None), "totallength": ("sum", "ratnagiri_final_total_length")}, None, None, False, None),
+        "Top 10 Contractors with Most Roads Completed": (["ratnagiri_final_contractor_name"], {"completedroads": ("count", None)}, completed_filter, "completedroads", False, 10),
+        "Bottom 10 Contractors with Fewest Roads Completed": (["ratnagiri_final_contractor_name"], {"completedroads": ("count", None)}, completed_filter, "completedroads", True, 10),
+        "Count of Roads by Scheme Name": (["ratnagiri_final_scheme_name"], {"roadcount": ("count", None)}, None, None, False, None),
+        "Average Expenditure by Road Category": (["roadcatego"], {"averageexpenditure": ("avg", "ratnagiri_final_total_expenditure")}, None, None, False, None),
+        "Total Length of Roads by Contractor": (["ratnagiri_final_contractor_name"], {"totallength": ("sum", "ratnagiri_final_total_length")}, None, None, False, None),
+        "Count of Roads by Status": (["ratnagiri_final_current_status"], {"roadcount": ("count", None)}, None, None, False, None),
+        "Average Length of Roads by Taluka": (["ratnagiri_final_taluka"], {"averagelength": ("avg", "ratnagiri_final_total_length")}, None, None, False, None),
+        "Count of Roads by Department": (["ratnagiri_final_department"], {"roadcount": ("count", None)}, None, None, False, None),
+        "Average PCI After Completion by Taluka": (["ratnagiri_final_taluka"], {"averagepci": ("avg", "ratnagiri_final_pci_after_completion_of_work")}, None, None, False, None),
+        "Total Expenditure by Block": (["block_name"], {"totalexpenditure": ("sum", "ratnagiri_final_total_expenditure")}, None, None, False, None),
+        "Contractor with Maximum Number of Roads": (["ratnagiri_final_contractor_name"], {"numberofroads": ("count", None)}, None, "numberofroads", False, 1),
+        "Count of Roads by Category of Work": (["ratnagiri_final_category_of_work"], {"roadcount": ("count", None)}, None, None, False, None),
+        "Average Approved Amount by Scheme Name": (["ratnagiri_final_scheme_name"], {"averageapprovedamount": ("avg", "ratnagiri_final_approved_amount")}, None, None, False, None),
+        "Total Expenditure by Road Owner": (["roadowner"], {"totalexpenditure": ("sum", "ratnagiri_final_total_expenditure")}, None, None, False, None),
     }
 
-    # Get the corresponding query for the selected report
-    query = queries.get(report_query)
+    # Remaining reports run as a single query on the division (or block) table
+    queries = {
+        "Roads with Highest Approved Amount (Top 10)": f'SELECT * FROM {road_table} ORDER BY "ratnagiri_final_approved_amount" DESC LIMIT 10',
+        "Roads with Lowest Approved Amount (Bottom 10)": f'SELECT * FROM {road_table} ORDER BY "ratnagiri_final_approved_amount" ASC LIMIT 10',
+        "Roads with Delayed Completion": f'SELECT * FROM {road_table} WHERE "ratnagiri_final_current_status" = \'Delayed\'',
+        "Roads with High Expenditure to Length Ratio (Top 10)": f'SELECT *, ("ratnagiri_final_total_expenditure" / "ratnagiri_final_total_length") AS ExpenditureToLengthRatio FROM {road_table} ORDER BY ExpenditureToLengthRatio DESC LIMIT 10',
+        "Median Approved Amount by Contractor": f'SELECT "ratnagiri_final_contractor_name", PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY "ratnagiri_final_approved_amount") AS MedianApprovedAmount FROM {road_table} GROUP BY "ratnagiri_final_contractor_name"',
+        "Top 10 Roads by Expenditure per Kilometer": f'SELECT *, ("ratnagiri_final_total_expenditure" / "ratnagiri_final_total_length") AS ExpenditurePerKm FROM {road_table} ORDER BY ExpenditurePerKm DESC LIMIT 10',
+        "Top 10 Roads by Total Expenditure": f'SELECT * FROM {road_table} ORDER BY "ratnagiri_final_total_expenditure" DESC LIMIT 10',
+        "Bottom 10 Roads by Total Expenditure": f'SELECT * FROM {road_table} ORDER BY "ratnagiri_final_total_expenditure" ASC LIMIT 10',
+    }
 
-    # Execute the query based on whether it requires geometry or not
-    if report_query in non_geom_queries:
-        df = fetch_non_geom_data(query)
+    # Execute the query based on whether it can fan out, requires geometry or not
+    if report_query in report_aggregates:
+        # Single-statement equivalent, shown to the user and used for exports. It is kept
+        # out of `query` so the merged result is not fetched a second time below.
+        report_sql = aggregate_sql(road_table, *report_aggregates[report_query])
+        st.write(f"Query: {report_sql}")
+        df = fetch_report_aggregate(selected_division, selected_block, *report_aggregates[report_query])
     else:
-        df = fetch_data(query)
+        # Get the corresponding query for the selected report
+        query = report_sql = queries.get(report_query)
+        query_workload = "report"
+        if report_query in non_geom_queries:
+            df = fetch_non_geom_data(query, query_workload)
+        else:
+            df = fetch_data(query, query_workload)
 
     # Display the results
     if report_query in non_geom_queries:
@@ -696,21 +747,72 @@ if category == "Analysis and Reporting":
     else:
         st.map(df)
 
+    export_query = report_sql
+    export_geom_col = None if report_query in non_geom_queries else 'geom'
+
     
 # Initialize gdf to an empty GeoDataFrame
 gdf = gpd.GeoDataFrame()
 
+# Filter categories export their query with geometry; reports override this above
+if category != "Analysis and Reporting":
+    export_query = query
+    export_geom_col = 'geom'
+
 # Execute and display the query results
 if query:
     st.subheader("Query Results")
     st.write(f"Query: {query}")
     
     try:
-        gdf = fetch_data(query)
+        gdf = fetch_data(query, query_workload)
         st.write(gdf)
     except Exception as e:
         st.error(f"An error occurred while fetching data: {e}")
 
+# Export the current query in the background instead of blocking this session
+if export_query:
+    st.subheader("Export Results")
+    export_formats = [fmt for fmt in EXPORT_FORMATS if export_geom_col or fmt not in GEOMETRY_FORMATS]
+    export_format = st.selectbox("Select Export Format", export_formats)
+    export_manager = get_export_manager()
+    export_jobs = st.session_state.setdefault("export_jobs", [])
+
+    count_rows = st.checkbox("Show export progress (counts the rows first, which runs the query twice)")
+
+    if st.button("Start Export"):
+        job_id = export_manager.submit(export_query, fmt=export_format, geom_col=export_geom_col, database_url=get_router().url_for('export'), count_rows=count_rows, file_name=f"{selected_division}_export")
+        export_jobs.append(job_id)
+
+    # Jobs whose exports have expired are dropped by the manager
+    statuses = {job_id: export_manager.status(job_id) for job_id in export_jobs}
+    export_jobs[:] = [job_id for job_id in export_jobs if statuses[job_id] is not None]
+    for job_id in reversed(export_jobs):
+        status = statuses[job_id]
+        label = f"{status['format'].upper()} export submitted at {status['submitted_at']}: {status['status']}"
+        if status['status'] == 'done':
+            # The file is only read into memory for the job the user asked to download, and only once
+            if st.session_state.get("export_download") == job_id:
+                del st.session_state["export_download"]
+                with open(export_manager.result_path(job_id), 'rb') as f:
+                    st.download_button(
+                        f"Download {label}",
+                        data=f,
+                        file_name=status['file_name'],
+                        key=f"download_{job_id}",
+                    )
+            elif st.button(f"Prepare download: {label}", key=f"prepare_{job_id}"):
+                st.session_state["export_download"] = job_id
+                st.rerun()
+        elif status['status'] == 'failed':
+            st.error(f"{label} ({status.get('error')})")
+        elif status['progress'] is None:
+            st.info(f"{label}, {status['rows_written']} rows written")
+        else:
+            st.progress(status['progress'], text=label)
+    if any(statuses[job_id]['status'] in ('queued', 'running') for job_id in export_jobs):
+        st.button("Refresh Export Status")
+
 # Create the folium map
 m = folium.Map(location=[17.0, 73.3], zoom_start=10)
 
@@ -718,12 +820,23 @@ m = folium.Map(location=[17.0, 73.3], zoom_start=10)
 show_district_boundaries = st.checkbox("Show District Boundaries", value=True)
 show_road_network = st.checkbox("Show Road Network", value=False)
 
+with st.expander("Cached Layer Memory Usage"):
+    st.write(pd.DataFrame({
+        name: {
+            "Rows": report["rows"],
+            "Before (KB, at least)": round(report["before_bytes"] / 1024, 1),
+            "After (KB)": round(report["after_bytes"] / 1024, 1),
+            "Reduction (at least)": f'{report["reduction"]:.0%}',
+        }
+        for name, report in [("District Boundaries", district_memory), ("Road Network", road_network_memory)]
+    }).T)
+
 # Create the folium map
 m = folium.Map(location=[17.0, 73.3], zoom_start=10)
 
 if show_district_boundaries:
     folium.GeoJson(
-        district_gdf,
+        district_layer,
         name="District Boundaries",
         style_function=lambda x: {
             'color': 'blue',
@@ -736,7 +849,7 @@ if show_district_boundaries:
 
 if show_road_network:
     folium.GeoJson(
-        road_network_gdf,
+        road_network_layer,
         name="Road Network",
         style_function=lambda x: {
             'color': 'green',
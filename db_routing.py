@@ -0,0 +1,248 @@
+# Per-workload connection pools (interactive, report, export) on the primary and on the read
+# replicas in DATABASE_REPLICA_URLS (comma separated). Reads go to a replica while its
+# replay lag is under MAX_REPLICA_LAG_SECONDS; `python db_routing.py` shows the routing.
+import itertools
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.pool import NullPool, QueuePool
+
+# Pool limits and statement timeout for each workload class
+WORKLOADS = {
+    'interactive': {'pool_size': 5, 'max_overflow': 5, 'pool_timeout': 5, 'statement_timeout_ms': 15000},
+    'report': {'pool_size': 2, 'max_overflow': 2, 'pool_timeout': 30, 'statement_timeout_ms': 120000},
+    'export': {'pool_size': 1, 'max_overflow': 1, 'pool_timeout': 60, 'statement_timeout_ms': 0},
+}
+
+MAX_REPLICA_LAG_SECONDS = float(os.getenv('MAX_REPLICA_LAG_SECONDS', '30'))
+
+# Seconds between replica lag checks, which run in a background thread
+LAG_CHECK_INTERVAL_SECONDS = float(os.getenv('LAG_CHECK_INTERVAL_SECONDS', '10'))
+
+# Workload guess for free-form SQL such as the API's /query, where the caller cannot say:
+# aggregations are reports, everything else is interactive. Callers that know the
+# workload (the dashboard's reports) pass it explicitly instead.
+_REPORT_PATTERN = re.compile(
+    r'\bGROUP\s+BY\b|\bPERCENTILE_CONT\b|\b(SUM|AVG|COUNT|MIN|MAX)\s*\(|\bOVER\s*\(', re.IGNORECASE
+)
+
+# Seconds allowed for opening a connection, so an unreachable replica drops out of rotation quickly
+CONNECT_TIMEOUT_SECONDS = 5
+
+# Last WAL position written on the primary, sampled before a replica is checked
+_PRIMARY_LSN_QUERY = text('SELECT pg_current_wal_lsn()')
+
+# Whether a database is a standby, whether it has replayed everything the primary had
+# written at `primary_lsn`, and the age of the last transaction it replayed
+_LAG_QUERY = text(
+    'SELECT pg_is_in_recovery(), '
+    'pg_last_wal_replay_lsn() >= CAST(:primary_lsn AS pg_lsn), '
+    'EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())'
+)
+
+
+def _url_string(url):
+    return url if isinstance(url, str) else url.render_as_string(hide_password=False)
+
+
+# Connections and overflow connections a workload's pool may hold
+def pool_capacity(workload):
+    return WORKLOADS[workload]['pool_size'] + WORKLOADS[workload]['max_overflow']
+
+
+# Driver arguments for a workload's connections: its statement timeout and a connect timeout
+def connect_args(workload):
+    if workload not in WORKLOADS:
+        raise ValueError(f"Unknown workload '{workload}', expected one of {sorted(WORKLOADS)}")
+    return {
+        'options': f'-c statement_timeout={WORKLOADS[workload]["statement_timeout_ms"]}',
+        'connect_timeout': CONNECT_TIMEOUT_SECONDS,
+    }
+
+
+def classify(sql):
+    return 'report' if _REPORT_PATTERN.search(sql) else 'interactive'
+
+
+def replica_urls_from_env():
+    return [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+
+
+class Router:
+    def __init__(self, primary_url, replica_urls=(), max_lag=MAX_REPLICA_LAG_SECONDS,
+                 lag_check_interval=LAG_CHECK_INTERVAL_SECONDS):
+        self.primary_url = _url_string(primary_url)
+        self.replica_urls = [_url_string(url) for url in replica_urls]
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self._engines = {}
+        self._probes = {}  # url -> unpooled engine used to check replica lag
+        self._lag = {}  # replica url -> (checked at, lag in seconds or None when unreachable)
+        self._lock = threading.Lock()
+        self._next_replica = itertools.count()
+        self._refresher = None
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_env(cls, primary_url):
+        return cls(primary_url, replica_urls_from_env())
+
+    # One engine, and so one pool, per (database, workload class)
+    def _engine(self, url, workload):
+        args = connect_args(workload)
+        key = (url, workload)
+        with self._lock:
+            if key not in self._engines:
+                settings = WORKLOADS[workload]
+                self._engines[key] = create_engine(
+                    url,
+                    poolclass=QueuePool,
+                    pool_size=settings['pool_size'],
+                    max_overflow=settings['max_overflow'],
+                    pool_timeout=settings['pool_timeout'],
+                    pool_pre_ping=True,
+                    connect_args=args,
+                )
+            return self._engines[key]
+
+    # Lag checks open their own short-lived connections, so a busy or exhausted
+    # workload pool can neither delay them nor be taken for an unreachable replica
+    def _probe(self, url, query, params=None):
+        with self._lock:
+            if url not in self._probes:
+                self._probes[url] = create_engine(
+                    url, poolclass=NullPool, connect_args={'connect_timeout': CONNECT_TIMEOUT_SECONDS}
+                )
+            engine = self._probes[url]
+        with engine.connect() as connection:
+            return connection.execute(query, params or {}).one()
+
+    # Replay lag in seconds: zero on a primary or on a replica that has replayed all the
+    # primary had written, otherwise the age of its last replayed transaction. None when
+    # the replica is unreachable, or behind with no replayed transaction to date the lag by.
+    def _measure_lag(self, url):
+        try:
+            primary_lsn = self._probe(self.primary_url, _PRIMARY_LSN_QUERY)[0]
+        except SQLAlchemyError:
+            primary_lsn = None  # Judge the replica by its replay timestamp alone
+        try:
+            in_recovery, caught_up, behind = self._probe(url, _LAG_QUERY, {'primary_lsn': primary_lsn})
+        except SQLAlchemyError:
+            return None
+        if not in_recovery or caught_up:
+            return 0.0
+        return None if behind is None else float(behind)
+
+    # Measure every replica now; run by the refresher thread, and directly by `__main__`
+    def refresh_lag(self):
+        for url in self.replica_urls:
+            lag = self._measure_lag(url)
+            self._lag[url] = (time.monotonic(), lag)
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh_lag()
+            except Exception:
+                pass  # Keep the last known values; the next round tries again
+            self._stop.wait(self.lag_check_interval)
+
+    # Lag is measured off the request path, so routing never waits on the network; a replica
+    # counts as unhealthy until its first check completes
+    def _ensure_refresher(self):
+        if self.replica_urls and self._refresher is None:
+            with self._lock:
+                if self._refresher is None:
+                    self._stop.clear()
+                    self._refresher = threading.Thread(target=self._refresh_loop, name='replica-lag', daemon=True)
+                    self._refresher.start()
+
+    # Last measured lag of a replica, None when unknown or unreachable
+    def replica_lag(self, url):
+        return self._lag.get(url, (None, None))[1]
+
+    def _mark_down(self, url):
+        self._lag[url] = (time.monotonic(), None)
+
+    def healthy_replicas(self):
+        self._ensure_refresher()
+        return [url for url in self.replica_urls
+                if (lag := self.replica_lag(url)) is not None and lag <= self.max_lag]
+
+    # URL of the database a piece of work should run on: a healthy replica for reads,
+    # spread round-robin, or the primary for writes and when no replica qualifies
+    def url_for(self, workload='interactive', readonly=True):
+        if readonly:
+            replicas = self.healthy_replicas()
+            if replicas:
+                return replicas[next(self._next_replica) % len(replicas)]
+        return self.primary_url
+
+    def engine(self, workload='interactive', readonly=True):
+        return self._engine(self.url_for(workload, readonly), workload)
+
+    def engine_for_query(self, sql, readonly=True):
+        return self.engine(classify(sql), readonly)
+
+    # Connection for a workload, falling back to the primary if the chosen replica is
+    # unreachable (which also takes it out of rotation) or its pool is exhausted
+    @contextmanager
+    def connect(self, workload='interactive', readonly=True):
+        url = self.url_for(workload, readonly)
+        try:
+            connection = self._engine(url, workload).connect()
+        except SQLAlchemyError as e:
+            if url == self.primary_url:
+                raise
+            if isinstance(e, OperationalError):
+                self._mark_down(url)
+            connection = self._engine(self.primary_url, workload).connect()
+        with connection:
+            yield connection
+
+    # Pools created so far, labelled '<workload>@<host>:<port>/<database>', with the most
+    # connections each may hold
+    def pools(self):
+        with self._lock:
+            pools = {}
+            for (url, workload), engine in self._engines.items():
+                parsed = make_url(url)
+                label = f'{workload}@{parsed.host}:{parsed.port or 5432}/{parsed.database}'
+                pools[label] = (engine.pool, pool_capacity(workload))
+            return pools
+
+    def status(self):
+        return {
+            'primary': make_url(self.primary_url).render_as_string(),
+            'replicas': {
+                make_url(url).render_as_string(): self.replica_lag(url) for url in self.replica_urls
+            },
+            'routes': {
+                workload: make_url(self.url_for(workload)).render_as_string() for workload in WORKLOADS
+            },
+        }
+
+    def dispose(self):
+        self._stop.set()
+        if self._refresher is not None:
+            self._refresher.join(timeout=CONNECT_TIMEOUT_SECONDS * 2)
+            self._refresher = None
+        with self._lock:
+            for engine in list(self._engines.values()) + list(self._probes.values()):
+                engine.dispose()
+            self._engines.clear()
+            self._probes.clear()
+
+
+if __name__ == "__main__":
+    import json
+
+    router = Router.from_env(os.getenv('DATABASE_URL', 'postgresql+psycopg2://localhost:5432/postgres'))
+    router.refresh_lag()
+    print(json.dumps(router.status(), indent=2))
@@ -0,0 +1,311 @@
+import os
+import time
+import uuid
+import tempfile
+import threading
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import geopandas as gpd
+import pandas as pd
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+
+# Supported export formats and the file extension used for each
+EXPORT_FORMATS = {
+    'csv': '.csv',
+    'gpkg': '.gpkg',
+    'parquet': '.parquet',
+}
+
+# Formats that need a geometry column to be written
+GEOMETRY_FORMATS = {'gpkg'}
+
+# Rows fetched from the database and written per chunk
+DEFAULT_CHUNKSIZE = 5000
+
+# Directory where finished exports are kept
+EXPORT_DIR = os.getenv('EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'road_db_exports'))
+
+# Worker and manager processes are spawned, not forked: the pool is started from a server
+# thread, and a child forked from a threaded process can deadlock on a copied lock
+MP_CONTEXT = multiprocessing.get_context('spawn')
+
+# Seconds a finished export (and its job record) is kept before it is deleted
+EXPORT_TTL_SECONDS = float(os.getenv('EXPORT_TTL_SECONDS', '3600'))
+
+# Expired exports are looked for at most this often
+CLEANUP_INTERVAL_SECONDS = 60
+
+# Parquet types for the Postgres type OIDs reported by the driver, so that a column
+# which is all NULL in the first chunk still gets its real type in the file schema
+PARQUET_TYPES = {
+    16: 'bool',
+    20: 'int64', 21: 'int64', 23: 'int64',
+    700: 'float64', 701: 'float64', 1700: 'float64',
+    25: 'string', 1042: 'string', 1043: 'string',
+    1082: 'date32',
+    1114: 'timestamp', 1184: 'timestamptz',
+}
+
+
+# Read the query in chunks so that a large extract never sits in memory at once
+def _read_chunks(connection, query, geom_col, chunksize):
+    if geom_col:
+        return gpd.read_postgis(text(query), con=connection, geom_col=geom_col, chunksize=chunksize)
+    return pd.read_sql(text(query), con=connection, chunksize=chunksize)
+
+
+# Postgres type OID of each column the query returns, without running it
+def _column_types(connection, query):
+    result = connection.execute(text(f'SELECT * FROM ({query}) AS export_query LIMIT 0'))
+    try:
+        return {column[0]: column[1] for column in result.cursor.description}
+    finally:
+        result.close()
+
+
+# Schema of the first Parquet chunk, with the columns pyarrow could only type as null
+# (all NULL in this chunk) given the type the database reports for them instead
+def _parquet_schema(schema, column_types, geom_col):
+    import pyarrow as pa
+
+    types = {
+        'bool': pa.bool_(), 'int64': pa.int64(), 'float64': pa.float64(), 'string': pa.string(),
+        'date32': pa.date32(), 'timestamp': pa.timestamp('us'), 'timestamptz': pa.timestamp('us', tz='UTC'),
+    }
+    fields = []
+    for field in schema:
+        if pa.types.is_null(field.type):
+            if field.name == geom_col:
+                field = field.with_type(pa.binary())
+            else:
+                field = field.with_type(types.get(PARQUET_TYPES.get(column_types.get(field.name)), pa.string()))
+        fields.append(field)
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+# Append one chunk to the export file; `writer` carries the open Parquet writer between chunks
+def _write_chunk(chunk, path, fmt, first, writer, column_types=None, geom_col=None):
+    if fmt == 'csv':
+        chunk.to_csv(path, mode='w' if first else 'a', header=first, index=False)
+    elif fmt == 'gpkg':
+        chunk.to_file(path, driver='GPKG', layer='export', mode='w' if first else 'a')
+    elif fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # Geometries are stored as WKB so every chunk shares one flat schema
+        frame = chunk.to_wkb() if isinstance(chunk, gpd.GeoDataFrame) else chunk
+        table = pa.Table.from_pandas(pd.DataFrame(frame), preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(path, _parquet_schema(table.schema, column_types or {}, geom_col))
+        table = table.cast(writer.schema)
+        writer.write_table(table)
+    return writer
+
+
+# Connect to the first of `database_urls` that accepts a connection; the later ones are
+# fallbacks, e.g. the primary behind a replica
+def _connect(database_urls, connect_args):
+    for i, url in enumerate(database_urls):
+        engine = create_engine(url, poolclass=NullPool, connect_args=connect_args or {})
+        try:
+            return engine, engine.connect()
+        except OperationalError:
+            engine.dispose()
+            if i == len(database_urls) - 1:
+                raise
+
+
+# Runs in a worker process: stream the query result into `path`, reporting progress as it goes.
+# With `count_rows` the query is first run as a COUNT(*) so progress can be shown as a
+# fraction; that executes the export query twice, so it is off by default.
+def run_export(database_urls, query, fmt, path, geom_col, chunksize, job_id, progress, count_rows=False,
+               connect_args=None):
+    engine = None
+    partial_path = path + '.part'
+    writer = None
+    rows_written = 0
+    total = None
+    try:
+        engine, connection = _connect(database_urls, connect_args)
+        with connection:
+            if count_rows:
+                total = connection.execute(text(f'SELECT COUNT(*) FROM ({query}) AS export_query')).scalar()
+            progress[job_id] = {'status': 'running', 'rows_written': 0, 'total_rows': total}
+            column_types = _column_types(connection, query) if fmt == 'parquet' else {}
+
+            streaming = connection.execution_options(stream_results=True)
+            for chunk in _read_chunks(streaming, query, geom_col, chunksize):
+                if geom_col and chunk.crs is None:
+                    chunk.set_crs(epsg=4326, inplace=True)  # Assuming the fetched data uses WGS84 CRS
+                writer = _write_chunk(chunk, partial_path, fmt, rows_written == 0, writer, column_types, geom_col)
+                rows_written += len(chunk)
+                progress[job_id] = {'status': 'running', 'rows_written': rows_written, 'total_rows': total}
+
+        if rows_written == 0:
+            # Still hand back a valid (empty) file when the query matched nothing
+            empty = gpd.GeoDataFrame(geometry=[], crs='EPSG:4326') if geom_col else pd.DataFrame()
+            writer = _write_chunk(empty, partial_path, fmt, True, None)
+        if writer is not None:
+            writer.close()
+            writer = None
+        os.replace(partial_path, path)
+        progress[job_id] = {
+            'status': 'done', 'rows_written': rows_written, 'total_rows': total, 'finished_at': time.time(),
+        }
+    except Exception as e:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        progress[job_id] = {
+            'status': 'failed', 'rows_written': rows_written, 'error': str(e), 'finished_at': time.time(),
+        }
+    finally:
+        if engine is not None:
+            engine.dispose()
+
+
+# Queue of export jobs executed by a process pool, so exports never block interactive requests.
+# Finished exports are deleted, and their jobs forgotten, `ttl_seconds` after they finish.
+# `connect_args` are passed to the driver for every export connection (e.g. a statement timeout).
+class ExportManager:
+    def __init__(self, database_url, export_dir=EXPORT_DIR, max_workers=2, chunksize=DEFAULT_CHUNKSIZE,
+                 ttl_seconds=EXPORT_TTL_SECONDS, connect_args=None):
+        self.database_url = database_url
+        self.connect_args = connect_args
+        self.export_dir = export_dir
+        self.max_workers = max_workers
+        self.chunksize = chunksize
+        self.ttl_seconds = ttl_seconds
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._manager = None
+        self._progress = None
+        self._last_cleanup = 0.0
+
+    # The pool and the shared progress dict are started on first use, not at import time
+    def _start(self):
+        if self._manager is None:
+            os.makedirs(self.export_dir, exist_ok=True)
+            self._manager = MP_CONTEXT.Manager()
+            self._progress = self._manager.dict()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=MP_CONTEXT)
+
+    # `database_url` overrides the manager's default for this job, e.g. to read from a replica;
+    # the default is still tried if that database cannot be reached. `file_name` (without
+    # extension) is the name the export is downloaded as.
+    def submit(self, query, fmt='csv', geom_col='geom', database_url=None, count_rows=False, file_name='export'):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format '{fmt}', expected one of {sorted(EXPORT_FORMATS)}")
+        if fmt in GEOMETRY_FORMATS and not geom_col:
+            raise ValueError(f"Export format '{fmt}' requires a geometry column")
+
+        self.cleanup()
+        with self._lock:
+            self._start()
+            job_id = uuid.uuid4().hex
+            path = os.path.join(self.export_dir, f'{job_id}{EXPORT_FORMATS[fmt]}')
+            self._progress[job_id] = {'status': 'queued', 'rows_written': 0}
+            args = (
+                list(dict.fromkeys([database_url or self.database_url, self.database_url])), query, fmt,
+                path, geom_col, self.chunksize, job_id, self._progress, count_rows, self.connect_args,
+            )
+            try:
+                future = self._executor.submit(run_export, *args)
+            except BrokenProcessPool:
+                # A worker died abruptly (e.g. killed for running out of memory), which breaks
+                # the whole pool; replace it so later exports still run
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+                self._start()
+                future = self._executor.submit(run_export, *args)
+            self.jobs[job_id] = {
+                'format': fmt,
+                'path': path,
+                'file_name': f'{file_name}{EXPORT_FORMATS[fmt]}',
+                'future': future,
+                'submitted_at': datetime.now().isoformat(timespec='seconds'),
+                'submitted_ts': time.time(),
+            }
+        return job_id
+
+    # Delete exports that finished more than `ttl_seconds` ago, along with their job and
+    # progress entries, and leftover files in `export_dir` (e.g. from a previous process)
+    def cleanup(self):
+        now = time.time()
+        cutoff = now - self.ttl_seconds
+        with self._lock:
+            self._last_cleanup = now
+            for job_id, job in list(self.jobs.items()):
+                if not job['future'].done():
+                    continue
+                finished_at = self._progress.get(job_id, {}).get('finished_at') or job['submitted_ts']
+                if finished_at > cutoff:
+                    continue
+                for path in (job['path'], job['path'] + '.part'):
+                    if os.path.exists(path):
+                        os.remove(path)
+                del self.jobs[job_id]
+                self._progress.pop(job_id, None)
+
+            if not os.path.isdir(self.export_dir):
+                return
+            known = {job['path'] for job in self.jobs.values()}
+            known |= {path + '.part' for path in known}
+            for name in os.listdir(self.export_dir):
+                path = os.path.join(self.export_dir, name)
+                try:
+                    if path not in known and os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass  # Removed by another process in the meantime
+
+    def status(self, job_id):
+        if time.time() - self._last_cleanup > CLEANUP_INTERVAL_SECONDS:
+            self.cleanup()
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        status = {
+            'job_id': job_id, 'format': job['format'], 'file_name': job['file_name'], 'submitted_at': job['submitted_at'],
+        }
+        status.update(self._progress.get(job_id, {}))
+
+        # A worker that died without reporting back still surfaces as a failure
+        future = job['future']
+        if future.done() and future.exception() is not None and status.get('status') != 'failed':
+            status.update({'status': 'failed', 'error': str(future.exception())})
+
+        total = status.get('total_rows')
+        if status.get('status') == 'done':
+            status['progress'] = 1.0
+        elif total:
+            status['progress'] = min(status['rows_written'] / total, 1.0)
+        elif total == 0:
+            status['progress'] = 0.0
+        else:
+            status['progress'] = None  # Rows were not counted, only `rows_written` is known
+        return status
+
+    # Path of a finished export, or None while the job is still queued or running
+    def result_path(self, job_id):
+        status = self.status(job_id)
+        if status is None or status['status'] != 'done':
+            return None
+        return self.jobs[job_id]['path']
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
@@ -0,0 +1,157 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import Response
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; responses fall back to gzip
+    brotli = None
+
+# Bodies smaller than this are sent uncompressed
+MIN_COMPRESS_SIZE = 1024
+
+# Encodings we can produce, in order of preference
+SUPPORTED_ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+# Weak validator from the data version and whatever identifies the request (query text,
+# parameters); weak because the gzip, brotli and plain bodies are equivalent representations
+def make_etag(*parts):
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    if '*' in candidates:
+        return True
+    bare = etag[2:] if etag.startswith('W/') else etag
+    return any((tag[2:] if tag.startswith('W/') else tag) == bare for tag in candidates)
+
+
+# Pick the preferred encoding the client accepts, honouring q=0
+def choose_encoding(accept_encoding):
+    if not accept_encoding:
+        return 'identity'
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in SUPPORTED_ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return 'identity'
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+# A response body with its compressed forms, encoded on first request and then reused
+# until `expires_at` (a time.monotonic() value, or None for no expiry)
+class CachedBody:
+    def __init__(self, body, expires_at=None):
+        self.body = body
+        self.expires_at = expires_at
+        self._encoded = {'identity': body}
+        self._lock = threading.Lock()
+
+    # Returns the body for `encoding` and whether it was just compressed (the size grew)
+    def encoded(self, encoding):
+        with self._lock:
+            if encoding in self._encoded:
+                return self._encoded[encoding], False
+            self._encoded[encoding] = compress(self.body, encoding)
+            return self._encoded[encoding], True
+
+    def size(self):
+        return sum(len(body) for body in self._encoded.values())
+
+
+# LRU of response bodies keyed by ETag, bounded by total size in bytes. Entries put with a
+# `ttl` expire after that many seconds, since the data version in an ETag only covers the
+# road tables and not, say, other relations or now() in a free-form query.
+class ResponseCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, etag):
+        with self._lock:
+            entry = self._entries.get(etag)
+            if entry is not None and entry.expires_at is not None and entry.expires_at <= time.monotonic():
+                del self._entries[etag]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(etag)
+            return entry
+
+    def put(self, etag, body, ttl=None):
+        entry = CachedBody(body, None if ttl is None else time.monotonic() + ttl)
+        with self._lock:
+            self._entries[etag] = entry
+            self._evict()
+        return entry
+
+    # Body of a cached entry in `encoding`; compressing adds a variant, so the size
+    # limit is enforced again whenever that happens
+    def encoded(self, entry, encoding):
+        body, added = entry.encoded(encoding)
+        if added:
+            with self._lock:
+                self._evict()
+        return body
+
+    def _evict(self):
+        total = sum(entry.size() for entry in self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            total -= entry.size()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Build a JSON response for `etag`, reusing a cached (and pre-compressed) body when there is one.
+# `build_payload` is only called on a cache miss, and a cached body is kept no longer than
+# the `max_age` clients are told. A matching If-None-Match gives 304 when `conditional` is
+# set, which should only be done for GET requests.
+def cached_json_response(request, cache, etag, build_payload, max_age=60, conditional=True):
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={max_age}',
+        'Vary': 'Accept-Encoding',
+    }
+    if conditional and etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+
+    entry = cache.get(etag)
+    if entry is None:
+        entry = cache.put(etag, json.dumps(build_payload()).encode(), ttl=max_age)
+
+    encoding = choose_encoding(request.headers.get('accept-encoding'))
+    if len(entry.body) < MIN_COMPRESS_SIZE:
+        encoding = 'identity'
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(cache.encoded(entry, encoding), media_type='application/json', headers=headers)
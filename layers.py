@@ -0,0 +1,139 @@
+import sys
+
+import numpy as np
+import pandas as pd
+import shapely
+
+# Attribute columns kept for each cached layer; everything else in the DBF is dropped
+ROAD_NETWORK_COLUMNS = ['DRRP_ROAD_', 'RoadCatego', 'RoadName', 'RoadOwner', 'Block_Name']
+DISTRICT_COLUMNS = ['NAME_3']
+
+# Text columns with few distinct values relative to rows are stored as categoricals
+CATEGORICAL_RATIO = 0.5
+
+# GeoJSON names of the geometry types produced by shapely.to_ragged_array
+_GEOJSON_TYPES = {
+    shapely.GeometryType.POINT: 'Point',
+    shapely.GeometryType.LINESTRING: 'LineString',
+    shapely.GeometryType.POLYGON: 'Polygon',
+    shapely.GeometryType.MULTIPOINT: 'MultiPoint',
+    shapely.GeometryType.MULTILINESTRING: 'MultiLineString',
+    shapely.GeometryType.MULTIPOLYGON: 'MultiPolygon',
+}
+
+
+# Shrink attribute columns: repetitive text becomes categorical, numbers are downcast,
+# and floats go to float32 only when every value survives the round trip exactly
+def compact_frame(df, columns=None):
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    df = df.copy()
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            if series.nunique(dropna=True) <= max(1, len(series) * CATEGORICAL_RATIO):
+                df[column] = series.astype('category')
+        elif pd.api.types.is_integer_dtype(series):
+            df[column] = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_float_dtype(series):
+            narrowed = series.astype('float32')
+            if ((narrowed.astype('float64') == series) | series.isna()).all():
+                df[column] = narrowed
+    return df
+
+
+# A vector layer held as packed coordinate arrays (shapely's ragged array encoding)
+# instead of one Shapely object per row
+class CompactLayer:
+    def __init__(self, attributes, geometry_type, coords, offsets, crs=None):
+        self.attributes = attributes
+        self.geometry_type = geometry_type
+        self.coords = coords
+        self.offsets = offsets
+        self.crs = crs
+
+    @classmethod
+    def from_geodataframe(cls, gdf, columns=None, coord_dtype=np.float32):
+        geometry_type, coords, offsets = shapely.to_ragged_array(gdf.geometry.to_numpy())
+        attributes = compact_frame(pd.DataFrame(gdf.drop(columns=gdf.geometry.name)), columns)
+        return cls(
+            attributes.reset_index(drop=True),
+            geometry_type,
+            np.ascontiguousarray(coords, dtype=coord_dtype),
+            tuple(np.asarray(o, dtype=np.int32) for o in offsets),
+            gdf.crs,
+        )
+
+    def __len__(self):
+        return len(self.attributes)
+
+    # Rebuild a GeoDataFrame, e.g. for spatial operations that need Shapely geometries
+    def to_geodataframe(self):
+        import geopandas as gpd
+
+        geometry = shapely.from_ragged_array(self.geometry_type, self.coords.astype(np.float64), self.offsets)
+        return gpd.GeoDataFrame(self.attributes.copy(), geometry=geometry, crs=self.crs)
+
+    # Coordinates of every feature as nested lists, sliced straight out of the packed arrays
+    def _coordinates(self):
+        parts = self.coords.tolist()
+        if self.offsets:
+            first = self.offsets[0]
+            parts = [parts[start:end] for start, end in zip(first[:-1], first[1:])]
+            for level in self.offsets[1:]:
+                parts = [parts[start:end] for start, end in zip(level[:-1], level[1:])]
+        return parts
+
+    # GeoJSON FeatureCollection, so the layer can be handed to folium.GeoJson directly
+    @property
+    def __geo_interface__(self):
+        geojson_type = _GEOJSON_TYPES[self.geometry_type]
+        records = self.attributes.astype(object).where(self.attributes.notna(), None).to_dict(orient='records')
+        features = [
+            {
+                'type': 'Feature',
+                'id': str(i),
+                'properties': properties,
+                'geometry': {'type': geojson_type, 'coordinates': coordinates},
+            }
+            for i, (properties, coordinates) in enumerate(zip(records, self._coordinates()))
+        ]
+        return {'type': 'FeatureCollection', 'features': features}
+
+    def memory_usage(self):
+        return {
+            'attributes': int(self.attributes.memory_usage(deep=True).sum()),
+            'geometry': int(self.coords.nbytes + sum(o.nbytes for o in self.offsets)),
+        }
+
+
+# Measured lower bound on the in-memory size of a GeoDataFrame. Attributes are measured
+# deeply by pandas; GEOS allocations are invisible to Python, so each geometry counts as its
+# Python wrapper plus its WKB encoding, which is no larger than the coordinates and headers
+# GEOS keeps for it.
+def geodataframe_memory_usage(gdf):
+    attributes = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+    geometries = gdf.geometry.to_numpy()
+    wkb = shapely.to_wkb(geometries)
+    geometry = geometries.nbytes + sum(sys.getsizeof(g) for g in geometries) + sum(len(b) for b in wkb if b is not None)
+    return {
+        'attributes': int(attributes.memory_usage(deep=True).sum()),
+        'geometry': int(geometry),
+    }
+
+
+# Before/after memory usage in bytes for reporting; "before" is a lower bound, so the
+# reduction is one too
+def memory_report(gdf, layer):
+    before = geodataframe_memory_usage(gdf)
+    after = layer.memory_usage()
+    total_before = sum(before.values())
+    total_after = sum(after.values())
+    return {
+        'rows': len(layer),
+        'before_bytes': total_before,
+        'after_bytes': total_after,
+        'reduction': 1 - total_after / total_before if total_before else 0.0,
+        'before': before,
+        'after': after,
+    }
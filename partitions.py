@@ -0,0 +1,340 @@
+import hashlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+# Divisions and the blocks each one is partitioned into. Onboarding a division
+# means adding it here and running `python partitions.py create <division>`; an
+# existing monolithic division table is moved over with `migrate` instead.
+DIVISIONS = {
+    'RN_DIV': ['RATNAGIRI', 'LANJA', 'SANGAMESHWAR', 'RAJAPUR'],
+}
+
+# Parent table, list-partitioned by division; each division table is in turn
+# list-partitioned by "block_name"
+ROAD_NETWORK_TABLE = 'road_network'
+
+# Partition catching rows whose block is not listed in DIVISIONS
+DEFAULT_BLOCK_PARTITION = 'OTHER'
+
+# Aggregates that can be computed per partition and merged afterwards
+MERGEABLE_AGGREGATES = {'sum', 'count', 'avg', 'min', 'max'}
+
+# Divisions found by `detect_partitions` to be stored as partitioned tables. Blocks of
+# any other division are read by filtering its monolithic table on "block_name".
+_partitioned = set()
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _check_division(division):
+    if division not in DIVISIONS:
+        raise ValueError(f"Unknown division '{division}', expected one of {sorted(DIVISIONS)}")
+
+
+# Name of the leaf partition holding one block of a division, e.g. RN_DIV_RATNAGIRI
+def block_partition_name(division, block):
+    return f'{division}_' + re.sub(r'\W+', '_', block).strip('_').upper()
+
+
+# Table to query for a division, or for a single block of it. Querying the block's
+# own partition prunes the other blocks without relying on the planner; a division
+# that has not been migrated yet gets an equivalent filtered subquery instead.
+def partition_table(division, block=None):
+    _check_division(division)
+    if block is None or block == 'All':
+        return quote_identifier(division)
+    if block not in DIVISIONS[division]:
+        raise ValueError(f"Unknown block '{block}' for division '{division}'")
+    name = quote_identifier(block_partition_name(division, block))
+    if division in _partitioned:
+        return name
+    return f'(SELECT * FROM {quote_identifier(division)} WHERE "block_name" = {quote_literal(block)}) AS {name}'
+
+
+def _leaf_names(division=None):
+    divisions = [division] if division is not None else list(DIVISIONS)
+    names = []
+    for name in divisions:
+        _check_division(name)
+        names += [block_partition_name(name, b) for b in DIVISIONS[name]]
+        names.append(block_partition_name(name, DEFAULT_BLOCK_PARTITION))
+    return names
+
+
+# Leaf partitions covering a division (or every division when `division` is None),
+# optionally narrowed down to one block. An unpartitioned division is a single leaf.
+def leaf_tables(division=None, block=None):
+    if block is not None and block != 'All':
+        return [partition_table(division, block)]
+    divisions = [division] if division is not None else list(DIVISIONS)
+    tables = []
+    for name in divisions:
+        if name in _partitioned:
+            tables += [quote_identifier(leaf) for leaf in _leaf_names(name)]
+        else:
+            _check_division(name)
+            tables.append(quote_identifier(name))
+    return tables
+
+
+# Record which divisions are partitioned tables in the connected database; called
+# once at startup by the dashboard and the API
+def detect_partitions(connection):
+    names = connection.execute(
+        text("SELECT relname FROM pg_class WHERE relkind = 'p' AND relname = ANY(:names)"),
+        {'names': list(DIVISIONS)},
+    ).scalars().all()
+    _partitioned.clear()
+    _partitioned.update(names)
+    return set(_partitioned)
+
+
+# Cheap token that changes whenever rows of a division are inserted, updated or deleted,
+# read from the catalog and table statistics instead of scanning the data. The write
+# counters alone can come back to an earlier value after pg_stat_reset() or a restart,
+# so the statistics reset time and the server start time are part of the token, and
+# the tables' file nodes are too since TRUNCATE replaces them without counting rows.
+# Also returns whether the server is a standby and its WAL position (replayed, on a standby).
+def _local_version(connection, division):
+    names = _leaf_names(division) + ([division] if division is not None else list(DIVISIONS))
+    row = connection.execute(
+        text(
+            'SELECT COALESCE(SUM(s.n_tup_ins + s.n_tup_upd + s.n_tup_del), 0), '
+            "string_agg(c.relname || ':' || pg_relation_filenode(c.oid), ',' ORDER BY c.relname), "
+            'pg_postmaster_start_time(), '
+            '(SELECT stats_reset FROM pg_stat_database WHERE datname = current_database()), '
+            'pg_is_in_recovery(), '
+            'CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END '
+            'FROM pg_class c LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid '
+            'WHERE c.relname = ANY(:names)'
+        ),
+        {'names': names},
+    ).one()
+    digest = hashlib.sha256('|'.join(str(value) for value in row[:4]).encode()).hexdigest()[:16]
+    return f'{division or "all"}-{row[0]}-{digest}', row[4], row[5]
+
+
+# Data version of a division as seen through `connection`. A standby does not count the
+# writes it replays, so there the version is the primary's, read through `primary` (a
+# callable returning a connection context manager), and used only once the standby has
+# replayed past the WAL position the primary was at when it was read. Without a reachable
+# primary, or while the standby is behind it, the token is the standby's replay position,
+# which is correct but moves with every replayed write, so caching barely helps then.
+def data_version(connection, division=None, primary=None):
+    version, in_recovery, lsn = _local_version(connection, division)
+    if not in_recovery:
+        return version
+    if primary is not None:
+        try:
+            with primary() as primary_connection:
+                version, _, primary_lsn = _local_version(primary_connection, division)
+        except SQLAlchemyError:
+            primary_lsn = None
+        if primary_lsn is not None:
+            caught_up = connection.execute(
+                text('SELECT pg_last_wal_replay_lsn() >= CAST(:lsn AS pg_lsn)'), {'lsn': str(primary_lsn)}
+            ).scalar()
+            if caught_up:
+                return version
+    return f'{division or "all"}-replay-{lsn}'
+
+
+# Statements creating the partitioned parent table, using `template_table` for the columns
+def road_network_ddl(template_table):
+    parent = quote_identifier(ROAD_NETWORK_TABLE)
+    return [
+        f'CREATE TABLE IF NOT EXISTS {parent} '
+        f'(LIKE {quote_identifier(template_table)} INCLUDING DEFAULTS, "division" text NOT NULL) '
+        f'PARTITION BY LIST ("division")',
+        f'CREATE INDEX IF NOT EXISTS "road_network_geom_idx" ON {parent} USING GIST ("geom")',
+        f'CREATE INDEX IF NOT EXISTS "road_network_block_name_idx" ON {parent} ("block_name")',
+    ]
+
+
+# Statements creating a division partition and one sub-partition per block
+def division_ddl(division):
+    _check_division(division)
+    division_table = quote_identifier(division)
+    statements = [
+        f'CREATE TABLE IF NOT EXISTS {division_table} PARTITION OF {quote_identifier(ROAD_NETWORK_TABLE)} '
+        f'FOR VALUES IN ({quote_literal(division)}) PARTITION BY LIST ("block_name")'
+    ]
+    for block in DIVISIONS[division]:
+        statements.append(
+            f'CREATE TABLE IF NOT EXISTS {quote_identifier(block_partition_name(division, block))} '
+            f'PARTITION OF {division_table} FOR VALUES IN ({quote_literal(block)})'
+        )
+    statements.append(
+        f'CREATE TABLE IF NOT EXISTS {quote_identifier(block_partition_name(division, DEFAULT_BLOCK_PARTITION))} '
+        f'PARTITION OF {division_table} DEFAULT'
+    )
+    return statements
+
+
+# Create the partitioned parent table (if needed) and an empty division with its blocks
+def create_division(engine, division, template_table):
+    with engine.begin() as connection:
+        for statement in road_network_ddl(template_table) + division_ddl(division):
+            connection.execute(text(statement))
+    _partitioned.add(division)
+
+
+# Move an existing monolithic division table (such as the original "RN_DIV") into
+# the partitioned layout. The old table is kept as "<division>_unpartitioned".
+def migrate_division(engine, division):
+    _check_division(division)
+    source = f'{division}_unpartitioned'
+    with engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE {quote_identifier(division)} RENAME TO {quote_identifier(source)}'))
+        for statement in road_network_ddl(source) + division_ddl(division):
+            connection.execute(text(statement))
+        connection.execute(text(
+            f'INSERT INTO {quote_identifier(ROAD_NETWORK_TABLE)} '
+            f'SELECT *, {quote_literal(division)} FROM {quote_identifier(source)}'
+        ))
+    _partitioned.add(division)
+
+
+# Run `build_query(table)` against every table in parallel and return one DataFrame per table.
+# `connect` returns a connection context manager, e.g. `lambda: router.connect('report')`.
+def fan_out(connect, tables, build_query, max_workers=4):
+    def run(table):
+        with connect() as connection:
+            return pd.read_sql(text(build_query(table)), con=connection)
+
+    if len(tables) == 1:
+        return [run(tables[0])]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tables))) as pool:
+        return list(pool.map(run, tables))
+
+
+def _check_aggregates(aggregates):
+    for alias, (func, column) in aggregates.items():
+        if func not in MERGEABLE_AGGREGATES:
+            raise ValueError(f"Aggregate '{func}' for '{alias}' cannot be merged across partitions")
+
+
+def _aggregate_expression(func, column):
+    return f'{func.upper()}({quote_identifier(column) if column else "*"})'
+
+
+def _group_sql(table, select, group_by, where):
+    sql = f'SELECT {", ".join(select)} FROM {table}'
+    if where:
+        sql += f' WHERE {where}'
+    if group_by:
+        sql += ' GROUP BY ' + ', '.join(quote_identifier(c) for c in group_by)
+    return sql
+
+
+# Single-statement form of an aggregate report, as it would run against one table.
+# `aggregates` maps an output alias to (function, column); column None means COUNT(*).
+def aggregate_sql(table, group_by, aggregates, where=None, order_by=None, ascending=False, limit=None):
+    _check_aggregates(aggregates)
+    select = [quote_identifier(c) for c in group_by]
+    select += [f'{_aggregate_expression(func, column)} AS {quote_identifier(alias)}'
+               for alias, (func, column) in aggregates.items()]
+    sql = _group_sql(table, select, group_by, where)
+    if order_by:
+        sql += f' ORDER BY {quote_identifier(order_by)} {"ASC" if ascending else "DESC"}'
+    if limit:
+        sql += f' LIMIT {int(limit)}'
+    return sql
+
+
+# Per-partition form of an aggregate report; AVG is split into a SUM and a COUNT
+def partial_aggregate_sql(table, group_by, aggregates, where=None):
+    _check_aggregates(aggregates)
+    select = [quote_identifier(c) for c in group_by]
+    for alias, (func, column) in aggregates.items():
+        if func == 'avg':
+            select.append(f'SUM({quote_identifier(column)}) AS {quote_identifier(alias + "__sum")}')
+            select.append(f'COUNT({quote_identifier(column)}) AS {quote_identifier(alias + "__count")}')
+        else:
+            select.append(f'{_aggregate_expression(func, column)} AS {quote_identifier(alias)}')
+    return _group_sql(table, select, group_by, where)
+
+
+# Combine per-partition results produced by `partial_aggregate_sql`
+def merge_partials(frames, group_by, aggregates):
+    combined = pd.concat(frames, ignore_index=True)
+    how = {}
+    for alias, (func, column) in aggregates.items():
+        if func == 'avg':
+            how[alias + '__sum'] = 'sum'
+            how[alias + '__count'] = 'sum'
+        else:
+            how[alias] = 'sum' if func == 'count' else func
+
+    # min_count=1 keeps SUM over only-NULL values as NULL, like SQL does
+    if group_by:
+        grouped = combined.groupby(group_by, dropna=False, sort=False)
+        merged = pd.DataFrame({
+            name: grouped[name].sum(min_count=1) if agg == 'sum' else grouped[name].agg(agg)
+            for name, agg in how.items()
+        }).reset_index()
+    else:
+        merged = pd.DataFrame({
+            name: [combined[name].sum(min_count=1) if agg == 'sum' else combined[name].agg(agg)]
+            for name, agg in how.items()
+        })
+
+    for alias, (func, column) in aggregates.items():
+        if func == 'avg':
+            merged[alias] = merged.pop(alias + '__sum') / merged.pop(alias + '__count').replace(0, float('nan'))
+        elif func == 'count':
+            merged[alias] = merged[alias].fillna(0).astype('int64')
+    return merged[list(group_by) + list(aggregates)]
+
+
+# Run an aggregate report over `tables` in parallel and merge the partial results
+def aggregate(connect, tables, group_by, aggregates, where=None, order_by=None, ascending=False, limit=None, max_workers=4):
+    frames = fan_out(
+        connect, tables, lambda table: partial_aggregate_sql(table, group_by, aggregates, where), max_workers
+    )
+    result = merge_partials(frames, group_by, aggregates)
+    if order_by:
+        result = result.sort_values(order_by, ascending=ascending, na_position='first' if not ascending else 'last')
+    if limit:
+        result = result.head(int(limit))
+    return result.reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    from sqlalchemy import create_engine
+
+    parser = argparse.ArgumentParser(description='Create or migrate the partitioned road network tables')
+    parser.add_argument('command', choices=['ddl', 'create', 'migrate'],
+                        help='ddl: print the statements; create: add an empty division; '
+                             'migrate: move an existing division table into partitions')
+    parser.add_argument('division', choices=sorted(DIVISIONS))
+    parser.add_argument('--template', help='Table whose columns the parent table copies (create only)')
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL'))
+    args = parser.parse_args()
+
+    if args.command == 'ddl':
+        print(';\n'.join(road_network_ddl(args.template or f'{args.division}_unpartitioned') + division_ddl(args.division)) + ';')
+    else:
+        if not args.database_url:
+            parser.error('--database-url or DATABASE_URL is required')
+        engine = create_engine(args.database_url)
+        if args.command == 'create':
+            if not args.template:
+                parser.error('create needs --template')
+            create_division(engine, args.division, args.template)
+        else:
+            migrate_division(engine, args.division)
+        print(f"Division '{args.division}' is partitioned by block")
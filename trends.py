@@ -0,0 +1,146 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from layers import compact_frame
+from partitions import data_version, partition_table, quote_identifier
+
+# Metrics available as trends: (value column, date column the value is bucketed by)
+TREND_METRICS = {
+    'pci': ('ratnagiri_final_pci_after_completion_of_work', 'ratnagiri_final_completion_certificate_date'),
+    'expenditure': ('ratnagiri_final_total_expenditure', 'ratnagiri_final_date_of_approval'),
+}
+
+# Dimensions a trend can be split by; None gives one series for the whole selection
+TREND_DIMENSIONS = {
+    'division': None,
+    'taluka': 'ratnagiri_final_taluka',
+    'contractor': 'ratnagiri_final_contractor_name',
+    'scheme': 'ratnagiri_final_scheme_name',
+}
+
+# Bucket sizes, as pandas period frequencies
+TREND_FREQUENCIES = {
+    'month': 'M',
+    'quarter': 'Q',
+}
+
+TREND_PERCENTILES = (0.5, 0.9)
+
+# Parsed frames kept per (division, data version), shared by the primary and replicas since
+# equal versions mean equal data, and trend results per request
+_FRAME_CACHE_SIZE = 4
+_RESULT_CACHE_SIZE = 128
+_frame_cache = OrderedDict()
+_result_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cached(cache, maxsize, key, compute):
+    with _cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    value = compute()
+    with _cache_lock:
+        cache[key] = value
+        while len(cache) > maxsize:
+            cache.popitem(last=False)
+    return value
+
+
+# Columns needed for every trend, fetched in a single query per data version
+def _trend_columns():
+    columns = {'block_name'}
+    for value_col, date_col in TREND_METRICS.values():
+        columns.update((value_col, date_col))
+    columns.update(c for c in TREND_DIMENSIONS.values() if c)
+    return sorted(columns)
+
+
+# Load the trend columns of a division and parse the dd.mm.yyyy dates once into datetime64.
+# Only the text columns are compacted; the values stay float64 so sums and means do not
+# pick up float32 rounding.
+def load_trend_frame(connection, division):
+    columns = ', '.join(quote_identifier(c) for c in _trend_columns())
+    frame = pd.read_sql(text(f'SELECT {columns} FROM {partition_table(division)}'), con=connection)
+
+    for value_col, date_col in TREND_METRICS.values():
+        frame[value_col] = pd.to_numeric(frame[value_col], errors='coerce')
+        if not pd.api.types.is_datetime64_any_dtype(frame[date_col]):
+            frame[date_col] = pd.to_datetime(frame[date_col], format='%d.%m.%Y', errors='coerce')
+    text_columns = ['block_name'] + [c for c in TREND_DIMENSIONS.values() if c]
+    frame[text_columns] = compact_frame(frame, text_columns)
+    return frame
+
+
+# Rolling sum and count over the last `window` buckets of each series, gaps included,
+# using cumulative sums instead of a Python loop per group
+def _rolling(codes, ordinals, sums, counts, window):
+    ordinals = ordinals - ordinals.min() if len(ordinals) else ordinals
+    span = (ordinals.max() if len(ordinals) else 0) + window
+    keys = codes * span + ordinals
+    starts = np.searchsorted(keys, keys - window + 1, side='left')
+    ends = np.arange(1, len(keys) + 1)
+    cumulative_sums = np.concatenate([[0.0], np.cumsum(sums)])
+    cumulative_counts = np.concatenate([[0], np.cumsum(counts)])
+    return cumulative_sums[ends] - cumulative_sums[starts], cumulative_counts[ends] - cumulative_counts[starts]
+
+
+# Bucketed sum, mean, count and percentiles of a metric per dimension, plus a rolling mean
+def compute_trend(frame, metric, by='division', freq='quarter', window=4, block=None):
+    value_col, date_col = TREND_METRICS[metric]
+    dimension = TREND_DIMENSIONS[by]
+    period_freq = TREND_FREQUENCIES[freq]
+
+    data = frame
+    if block is not None and block != 'All':
+        data = data[data['block_name'] == block]
+    data = data[data[date_col].notna() & data[value_col].notna()]
+
+    keys = [data[dimension].rename(by)] if dimension else [pd.Series('All', index=data.index, name=by)]
+    keys.append(data[date_col].dt.to_period(period_freq).rename('period'))
+    grouped = data[value_col].groupby(keys, observed=True, sort=True)
+
+    result = grouped.agg(['count', 'sum', 'mean'])
+    for q in TREND_PERCENTILES:
+        result[f'p{int(q * 100)}'] = grouped.quantile(q)
+    result = result.reset_index()
+
+    codes = pd.factorize(result[by], sort=True)[0].astype('int64')
+    ordinals = result['period'].array.asi8 if len(result) else np.array([], dtype='int64')
+    rolling_sum, rolling_count = _rolling(codes, ordinals, result['sum'].to_numpy(), result['count'].to_numpy(), window)
+    result['rolling_mean'] = np.divide(
+        rolling_sum, rolling_count, out=np.full(len(result), np.nan), where=rolling_count > 0
+    )
+    result['period'] = result['period'].dt.to_timestamp()
+    return result
+
+
+# Trend for a division, cached until its data version changes. The data is read on
+# `connection` and so is the version, with `primary` passed on to `data_version` for
+# when that connection is to a replica.
+def trend(connection, division, metric, by='division', freq='quarter', window=4, block=None, primary=None):
+    if metric not in TREND_METRICS:
+        raise ValueError(f"Unknown metric '{metric}', expected one of {sorted(TREND_METRICS)}")
+    if by not in TREND_DIMENSIONS:
+        raise ValueError(f"Unknown dimension '{by}', expected one of {sorted(TREND_DIMENSIONS)}")
+    if freq not in TREND_FREQUENCIES:
+        raise ValueError(f"Unknown frequency '{freq}', expected one of {sorted(TREND_FREQUENCIES)}")
+    if window < 1:
+        raise ValueError('Rolling window must be at least one bucket')
+    partition_table(division, block)
+
+    version = data_version(connection, division, primary)
+    frame_key = (division, version)
+    frame = _cached(_frame_cache, _FRAME_CACHE_SIZE, frame_key, lambda: load_trend_frame(connection, division))
+
+    result_key = frame_key + (metric, by, freq, window, block)
+    result = _cached(
+        _result_cache, _RESULT_CACHE_SIZE, result_key,
+        lambda: compute_trend(frame, metric, by, freq, window, block),
+    )
+    return result.copy()